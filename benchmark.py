@@ -0,0 +1,170 @@
+"""合成台帳による在庫処理のベンチマーク（画面なしで実行）
+
+使い方:
+    python benchmark.py --sizes 1000 10000 100000 --categories 20 --locations 5 --output bench.json
+
+結果はJSONで出力されるため、バージョン間で比較して性能劣化を確認できる。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import inventory_core as core
+from sort_index import SortIndex
+
+
+def generate_ledger(rows, categories=20, locations=5, seed=0):
+    """合成台帳（レコードのリスト）を生成する"""
+    rng = random.Random(seed)
+    category_names = [f"カテゴリ{i:03d}" for i in range(categories)]
+    location_names = [f"倉庫{i:03d}" for i in range(locations)]
+    ledger = []
+    for i in range(rows):
+        ledger.append({
+            "id": f"P{i:07d}",
+            "name": f"商品{i:07d}",
+            "category": rng.choice(category_names),
+            "quantity": rng.randint(0, 200),
+            "location": rng.choice(location_names),
+            "threshold": core.DEFAULT_THRESHOLD,
+            "order_pending": rng.random() < 0.05,
+        })
+    return ledger
+
+
+def generate_movements(ledger, count, seed=0):
+    """入出庫の明細（id, qty, direction）を生成する。出庫は1個ずつ"""
+    rng = random.Random(seed)
+    movements = []
+    for _ in range(count):
+        item = rng.choice(ledger)
+        if rng.random() < 0.5:
+            movements.append({"id": item["id"], "qty": rng.randint(1, 20), "direction": "in"})
+        else:
+            movements.append({"id": item["id"], "qty": 1, "direction": "out"})
+    return movements
+
+
+def _timeit(func, repeat):
+    """func を repeat 回実行し、各回の経過秒数のリストを返す"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _summary(timings):
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+        "repeat": len(timings),
+    }
+
+
+def run_size(rows, categories, locations, movements, repeat, workdir):
+    """1つの台帳サイズについて各処理を計測する"""
+    ledger = generate_ledger(rows, categories, locations)
+    moves = generate_movements(ledger, movements)
+    excel_path = os.path.join(workdir, f"ledger_{rows}.xlsx")
+    import_path = os.path.join(workdir, f"import_{rows}.csv")
+    picking_path = os.path.join(workdir, f"picking_{rows}.csv")
+    core.save_inventory(excel_path, ledger)
+    pd.DataFrame(generate_ledger(max(rows // 10, 1), categories, locations, seed=1)).to_csv(import_path, index=False)
+
+    # 入庫のあとに同数の出庫を並べたピッキングリスト（繰り返し実行しても在庫が変わらない）
+    batch = [dict(m, direction="in") for m in moves] + [dict(m, direction="out") for m in moves]
+    pd.DataFrame(batch).to_csv(picking_path, index=False)
+
+    selected_categories = sorted({core.item_category(item) for item in ledger})[:max(categories // 4, 1)]
+    selected_locations = sorted({core.item_location(item) for item in ledger})[:1]
+    lookup_ids = [m["id"] for m in moves]
+
+    def display():
+        for item in core.filter_inventory(ledger, selected_categories, selected_locations):
+            core.inventory_row_values(item)
+
+    def lookup():
+        for item_id in lookup_ids:
+            core.find_item_by_id(ledger, item_id)
+
+    def stock_in_out():
+        for m in moves:
+            item = core.find_item_by_id(ledger, m["id"])
+            if m["direction"] == "in":
+                core.apply_stock_in(item, m["qty"])
+            else:
+                try:
+                    core.apply_stock_out(item, m["qty"])
+                except ValueError:
+                    pass
+
+    def sort_multi():
+        # キャッシュの無い状態から数量・保管場所の2列で並べ替える
+        SortIndex().sorted_positions(ledger, [("quantity", False), ("location", True)])
+
+    results = {
+        "load_excel": _timeit(lambda: core.load_inventory(excel_path), repeat),
+        "filter_display": _timeit(display, repeat),
+        "id_lookup": _timeit(lookup, repeat),
+        "stock_in_out": _timeit(stock_in_out, repeat),
+        "batch_movements": _timeit(lambda: core.apply_movements(ledger, core.read_picking_list(picking_path)), repeat),
+        "save_excel": _timeit(lambda: core.save_inventory(excel_path, ledger), repeat),
+        "sort_multi": _timeit(sort_multi, repeat),
+        "check_low_stock": _timeit(lambda: core.find_low_stock_items(ledger), repeat),
+        "import_csv": _timeit(lambda: core.read_import_file(import_path), repeat),
+    }
+    return {
+        "rows": rows,
+        "categories": categories,
+        "locations": locations,
+        "movements": movements,
+        "results": {name: _summary(timings) for name, timings in results.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在庫管理アプリの処理時間を合成台帳で計測します")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="台帳の行数（1000〜1000000）")
+    parser.add_argument("--categories", type=int, default=20, help="カテゴリの種類数")
+    parser.add_argument("--locations", type=int, default=5, help="保管場所の種類数")
+    parser.add_argument("--movements", type=int, default=100, help="入出庫・ID検索の件数")
+    parser.add_argument("--repeat", type=int, default=3, help="各処理の繰り返し回数")
+    parser.add_argument("--output", default=None, help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in args.sizes:
+            print(f"計測中: {rows} 行", file=sys.stderr)
+            report["runs"].append(run_size(rows, args.categories, args.locations,
+                                           args.movements, args.repeat, workdir))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""在庫台帳の画面に依存しない処理（読み込み・絞り込み・入出庫・保存など）"""
+import io
+
+from lazy_imports import LazyModule
+
+pd = LazyModule("pandas")
+
+DEFAULT_THRESHOLD = 5
+UNSET_LABEL = "未設定"
+IMPORT_COLUMNS = ['id', 'name', 'category', 'quantity', 'location', 'threshold', 'order_pending']
+
+
+def load_inventory(path):
+    """Excel台帳を読み込み、閾値未設定の行にはデフォルト値を入れたレコードのリストを返す"""
+    df = pd.read_excel(path)
+    inventory_data = df.to_dict("records")
+    for item in inventory_data:
+        if "threshold" not in item or pd.isna(item["threshold"]):
+            item["threshold"] = DEFAULT_THRESHOLD
+    return inventory_data
+
+
+def save_inventory(path, inventory_data):
+    """レコードのリストをExcel台帳に書き出す"""
+    pd.DataFrame(inventory_data).to_excel(path, index=False)
+
+
+def item_category(item):
+    return str(item.get("category") or UNSET_LABEL)
+
+
+def item_location(item):
+    return str(item.get("location") or UNSET_LABEL)
+
+
+def item_quantity(item):
+    """数量を整数で返す（欠損・不正値は0）"""
+    try:
+        qty = item.get("quantity", 0)
+        return 0 if pd.isna(qty) else int(qty)
+    except Exception:
+        return 0
+
+
+def filter_inventory(inventory_data, selected_categories, selected_locations):
+    """カテゴリ・保管場所の選択条件に合うレコードを返す（未選択の条件は無視）"""
+    filtered = []
+    for item in inventory_data:
+        if selected_categories and (item_category(item) not in selected_categories):
+            continue
+        if selected_locations and (item_location(item) not in selected_locations):
+            continue
+        filtered.append(item)
+    return filtered
+
+
+def inventory_row_values(item):
+    """Treeview 1行分の表示値を返す"""
+    threshold = item.get("threshold")
+    if threshold is None or pd.isna(threshold):
+        threshold = UNSET_LABEL
+    # 発注中なら商品名の前に【発注中】を表示
+    name_to_show = item["name"]
+    if item.get("order_pending", False):
+        name_to_show = "【発注中】" + name_to_show
+    return (item["id"], name_to_show, item["category"], item_quantity(item), item_location(item), threshold)
+
+
+def find_item_by_id(inventory_data, item_id):
+    return next((item for item in inventory_data if str(item["id"]) == str(item_id)), None)
+
+
+def find_item_in_qr(inventory_data, qr_data):
+    """QRコードの文字列にIDが含まれる最初のレコードを返す"""
+    return next((item for item in inventory_data if str(item["id"]) in qr_data), None)
+
+
+def apply_stock_in(item, add_qty):
+    try:
+        current_qty = int(item.get("quantity", 0))
+        item["quantity"] = current_qty + add_qty
+        if item.get("order_pending", False):
+            item["order_pending"] = False
+    except Exception:
+        item["quantity"] = add_qty
+
+
+def apply_stock_out(item, remove_qty):
+    """出庫数量を差し引く。在庫を超える場合は ValueError"""
+    try:
+        current_qty = int(item.get("quantity", 0))
+    except Exception:
+        current_qty = 0
+    if remove_qty > current_qty:
+        raise ValueError("出庫数量が在庫数量を超えています。")
+    item["quantity"] = current_qty - remove_qty
+
+
+def find_low_stock_items(inventory_data, limit=DEFAULT_THRESHOLD):
+    """在庫数量が limit 以下で、発注中でないレコードを返す"""
+    low_stock_items = []
+    for item in inventory_data:
+        qty = item.get("quantity", 0)
+        if pd.isna(qty):
+            qty = 0
+        else:
+            qty = int(qty)
+        # order_pending が True の場合は既に発注中なので通知対象外とする
+        if qty <= limit and not item.get("order_pending", False):
+            low_stock_items.append(item)
+    return low_stock_items
+
+
+def read_import_file(filepath):
+    """CSV/Excelを読み込み、台帳に追加するレコードのリストを返す。必須列が無い場合は ValueError"""
+    # ファイル拡張子によって読み込み方法を切り替える
+    if filepath.lower().endswith(('.xlsx', '.xls')):
+        data = pd.read_excel(filepath)
+    else:
+        data = pd.read_csv(filepath)
+
+    missing = [col for col in IMPORT_COLUMNS if col not in data.columns]
+    if missing:
+        raise ValueError(f"次の列が不足しています: {', '.join(missing)}")
+
+    records = []
+    for _, row in data.iterrows():
+        records.append({
+            "id": row['id'],
+            "name": row['name'],
+            "category": row['category'],
+            "quantity": row['quantity'],
+            "location": row['location'],
+            "threshold": row['threshold'],
+            # order_pending 列が存在するかチェックし、欠損値の場合は False を設定
+            "order_pending": row['order_pending'] if not pd.isna(row.get('order_pending', False)) else False
+        })
+    return records
+
+
+# 一括入出庫の方向指定として受け付ける値
+DIRECTIONS = {"in": "in", "入庫": "in", "+": "in", "out": "out", "出庫": "out", "-": "out"}
+PICKING_COLUMNS = ['id', 'qty', 'direction']
+MAX_REPORTED_ERRORS = 20
+# 1明細の数量の上限（1e30 のような誤入力を弾く）
+MAX_MOVEMENT_QTY = 1_000_000
+
+
+class MovementError(ValueError):
+    """一括入出庫の検証エラー。errors に明細ごとのメッセージを保持する"""
+
+    def __init__(self, errors):
+        shown = errors[:MAX_REPORTED_ERRORS]
+        if len(errors) > len(shown):
+            shown = shown + [f"…ほか {len(errors) - len(shown)} 件"]
+        super().__init__("\n".join(shown))
+        self.errors = errors
+
+
+def build_id_index(inventory_data):
+    """ID文字列からレコードへの辞書を作る（IDが重複する場合は先頭のレコード）"""
+    index = {}
+    for item in inventory_data:
+        index.setdefault(str(item["id"]), item)
+    return index
+
+
+def _movements_from_frame(data):
+    missing = [col for col in PICKING_COLUMNS if col not in data.columns]
+    if missing:
+        raise ValueError(f"次の列が不足しています: {', '.join(missing)}")
+    movements = []
+    for line, row in enumerate(data[PICKING_COLUMNS].itertuples(index=False), start=2):  # 1行目は見出し
+        movements.append({"id": row.id, "qty": row.qty, "direction": row.direction, "line": line})
+    return movements
+
+
+def read_picking_list(filepath):
+    """ピッキングリスト（id, qty, direction 列のCSV/Excel）を読み込み、明細のリストを返す"""
+    if filepath.lower().endswith(('.xlsx', '.xls')):
+        data = pd.read_excel(filepath, dtype={"id": str})
+    else:
+        data = pd.read_csv(filepath, dtype={"id": str})
+    return _movements_from_frame(data)
+
+
+def parse_picking_list(text):
+    """貼り付けられたCSV文字列のピッキングリストを明細のリストにする"""
+    return _movements_from_frame(pd.read_csv(io.StringIO(text), dtype={"id": str}))
+
+
+def parse_movement_qty(value):
+    """明細の数量を整数にする。1〜MAX_MOVEMENT_QTY の整数でなければ None"""
+    try:
+        qty = pd.to_numeric(value, errors="coerce")
+        # 上限内なら float でも整数部は正確なので、範囲を確かめてから整数にする
+        if not 1 <= qty <= MAX_MOVEMENT_QTY or qty != int(qty):
+            return None
+        return int(qty)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def validate_movements(inventory_data, movements):
+    """全明細を検証し、(レコード, 数量, 方向) のリストを返す。不正な明細があれば MovementError
+
+    出庫は同じリスト内の先行する入出庫を反映した見込み在庫で判定する。
+    """
+    index = build_id_index(inventory_data)
+    projected = {}
+    resolved = []
+    errors = []
+    for number, movement in enumerate(movements, start=1):
+        line = movement.get("line", number)
+        item_id = "" if pd.isna(movement.get("id")) else str(movement["id"]).strip()
+        item = index.get(item_id)
+        direction = DIRECTIONS.get(str(movement.get("direction", "")).strip().lower())
+        qty = parse_movement_qty(movement.get("qty"))
+
+        if item is None:
+            errors.append(f"{line}行目: IDが見つかりません: {item_id}")
+            continue
+        if direction is None:
+            errors.append(f"{line}行目: 方向は in/out（入庫/出庫）で指定してください: {movement.get('direction')}")
+            continue
+        if qty is None:
+            errors.append(f"{line}行目: 数量は1〜{MAX_MOVEMENT_QTY}の整数で指定してください: {movement.get('qty')}")
+            continue
+
+        current_qty = projected.get(item_id, item_quantity(item))
+        if direction == "out" and qty > current_qty:
+            errors.append(f"{line}行目: {item['name']} の出庫数量が在庫数量を超えています（在庫: {current_qty}, 出庫: {qty}）")
+            continue
+        projected[item_id] = current_qty + qty if direction == "in" else current_qty - qty
+        resolved.append((item, qty, direction))
+
+    if errors:
+        raise MovementError(errors)
+    return resolved
+
+
+def commit_movements(resolved):
+    """validate_movements の結果をレコードに反映する
+
+    反映前に現在の在庫で出庫できるかを全明細について確かめ、足りなければ何も変更せずに MovementError。
+    """
+    projected = {}
+    errors = []
+    for item, qty, direction in resolved:
+        current_qty = projected.get(id(item), item_quantity(item))
+        if direction == "out" and qty > current_qty:
+            errors.append(f"{item['name']} の出庫数量が在庫数量を超えています（在庫: {current_qty}, 出庫: {qty}）")
+            continue
+        projected[id(item)] = current_qty + qty if direction == "in" else current_qty - qty
+    if errors:
+        raise MovementError(errors)
+
+    for item, qty, direction in resolved:
+        if direction == "in":
+            apply_stock_in(item, qty)
+        else:
+            apply_stock_out(item, qty)
+    return resolved
+
+
+def apply_movements(inventory_data, movements):
+    """明細をすべて検証してから一括で反映する。1件でも不正があれば何も変更しない"""
+    return commit_movements(validate_movements(inventory_data, movements))
+
+
+COUNT_COLUMNS = ['id', 'counted']
+
+
+def counts_frame(counts):
+    """{id: 実棚数} の辞書を棚卸用のDataFrame（id, counted）にする"""
+    return pd.DataFrame({"id": [str(item_id) for item_id in counts], "counted": list(counts.values())})
+
+
+def read_count_sheet(filepath):
+    """棚卸表（id, counted 列のCSV/Excel）を読み込む。同じIDが複数行あれば合算する"""
+    if filepath.lower().endswith(('.xlsx', '.xls')):
+        data = pd.read_excel(filepath, dtype={"id": str})
+    else:
+        data = pd.read_csv(filepath, dtype={"id": str})
+    missing = [col for col in COUNT_COLUMNS if col not in data.columns]
+    if missing:
+        raise ValueError(f"次の列が不足しています: {', '.join(missing)}")
+
+    data = data[COUNT_COLUMNS].dropna(subset=["id"])
+    data["id"] = data["id"].str.strip()
+    counted = pd.to_numeric(data["counted"], errors="coerce")
+    invalid = counted.isna() | (counted < 0) | (counted != counted.round())
+    if invalid.any():
+        lines = ", ".join(str(i + 2) for i in data.index[invalid][:MAX_REPORTED_ERRORS])  # 1行目は見出し
+        raise ValueError(f"実棚数は0以上の整数で入力してください（{lines}行目）")
+    data["counted"] = counted.astype(int)
+    return data.groupby("id", as_index=False, sort=False)["counted"].sum()
+
+
+def compute_stock_variances(inventory_data, counts):
+    """実棚数と台帳数量の差異を一括で計算する
+
+    差異のある行だけを差異の絶対値が大きい順に並べたDataFrame
+    （id, name, location, quantity, counted, variance）と、台帳に無いIDのリストを返す。
+    数えていない品目は対象外とする。
+    """
+    ledger = pd.DataFrame({
+        "id": [str(item["id"]) for item in inventory_data],
+        "name": [item.get("name") for item in inventory_data],
+        "location": [item_location(item) for item in inventory_data],
+        "quantity": [item.get("quantity") for item in inventory_data],
+    }).drop_duplicates("id")
+    ledger["quantity"] = pd.to_numeric(ledger["quantity"], errors="coerce").fillna(0).astype(int)
+
+    merged = counts.merge(ledger, on="id", how="left", indicator=True)
+    unknown_ids = merged.loc[merged["_merge"] == "left_only", "id"].tolist()
+    merged = merged[merged["_merge"] == "both"].drop(columns="_merge")
+    merged["quantity"] = merged["quantity"].astype(int)
+    merged["variance"] = merged["counted"] - merged["quantity"]
+    variances = merged[merged["variance"] != 0]
+    variances = variances.sort_values("variance", key=lambda v: v.abs(), ascending=False, kind="stable")
+    columns = ["id", "name", "location", "quantity", "counted", "variance"]
+    return variances[columns].reset_index(drop=True), unknown_ids
+
+
+def apply_stocktake_adjustments(inventory_data, variances):
+    """差異の行の実棚数で台帳数量を置き換え、(レコード, 差異) のリストを返す"""
+    index = build_id_index(inventory_data)
+    adjustments = []
+    for row in variances.itertuples(index=False):
+        item = index.get(row.id)
+        if item is None:
+            continue
+        item["quantity"] = int(row.counted)
+        adjustments.append((item, int(row.variance)))
+    return adjustments
+
+
+def _same_value(a, b):
+    if a is b:
+        return True
+    if pd.isna(a) and pd.isna(b):
+        return True
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def diff_inventory(old_records, new_records):
+    """IDをキーに2つの台帳を比べ、行単位の差分 {"added", "changed", "removed"} を返す
+
+    added と changed は new_records 側のレコード、removed はIDのリスト。
+    片方にしか無い列は欠損値として比較する。
+    """
+    old_index = build_id_index(old_records)
+    new_index = build_id_index(new_records)
+    added = []
+    changed = []
+    for item_id, record in new_index.items():
+        old = old_index.get(item_id)
+        if old is None:
+            added.append(record)
+        elif any(not _same_value(old.get(col), record.get(col)) for col in old.keys() | record.keys()):
+            changed.append(record)
+    removed = [item_id for item_id in old_index if item_id not in new_index]
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+class LedgerConflictError(ValueError):
+    """この画面での変更を、ファイル上の最新の内容に重ねられない場合のエラー"""
+
+
+def rebase_record(base, local, latest):
+    """base（前回ファイルと一致していた行）から local への変更を、ファイル上の最新の行 latest に重ねる
+
+    数量は入出庫の差分（local - base）を latest の数量に足す。その他の列はこの画面で変更した列だけ local の値にする。
+    差分を足すと数量がマイナスになる場合は LedgerConflictError。
+    """
+    merged = dict(latest)
+    for col in local.keys() | base.keys():
+        if col != "quantity" and not _same_value(local.get(col), base.get(col)):
+            merged[col] = local.get(col)
+    quantity = item_quantity(latest) + item_quantity(local) - item_quantity(base)
+    if quantity < 0:
+        raise LedgerConflictError(
+            f"{local.get('name')} (ID: {local.get('id')}) は他の端末で在庫が減ったため、出庫を反映できません"
+            f"（最新の在庫: {item_quantity(latest)}）")
+    merged["quantity"] = quantity
+    return merged
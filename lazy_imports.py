@@ -0,0 +1,59 @@
+"""重いモジュール（OpenCV, pyzbar, pandas など）の遅延読み込みと読み込み時間の記録"""
+import importlib
+import sys
+import threading
+import time
+
+# モジュール名 -> (読み込み秒数, 読み込んだスレッド名)
+IMPORT_TIMES = {}
+_lock = threading.Lock()
+
+
+def load(name):
+    """モジュールを読み込み、初回の読み込み時間を記録して返す"""
+    already_loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    if not already_loaded:
+        with _lock:
+            IMPORT_TIMES.setdefault(name, (elapsed, threading.current_thread().name))
+    return module
+
+
+class LazyModule:
+    """属性に初めてアクセスした時点でモジュールを読み込む代理オブジェクト"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = load(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+def preload(names):
+    """バックグラウンドスレッドでモジュールを先読みする。失敗しても初回利用時に改めて読み込まれる"""
+    def worker():
+        for name in names:
+            try:
+                load(name)
+            except Exception as e:
+                print(f"{name} の先読みに失敗しました:", e)
+
+    thread = threading.Thread(target=worker, name="preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def import_report():
+    """モジュールの読み込み時間を遅い順に並べた行のリストを返す"""
+    with _lock:
+        items = sorted(IMPORT_TIMES.items(), key=lambda kv: kv[1][0], reverse=True)
+    return [f"{name:<24}{seconds * 1000:>10.1f} ms  ({thread})" for name, (seconds, thread) in items]
@@ -0,0 +1,98 @@
+"""台帳ファイルの外部更新の検知（更新日時・サイズのポーリング）"""
+import os
+import queue
+import threading
+
+import inventory_core as core
+
+
+def file_signature(path):
+    """ファイルの (更新日時, サイズ) を返す。存在しない・読めない場合は None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class LedgerWatcher:
+    """台帳ファイルを定期的に確認し、外部で更新されたら別スレッドで読み直して行単位の差分を求める
+
+    差分は (世代, diff) として changes キューに入る。画面側はメインスレッドでキューを取り出し、
+    is_current() が真のものだけを反映する（アプリ自身の保存より前に読んだ差分は捨てる）。
+    diff["base"] には変更された行の変更前の内容（{ID: レコード}）が入る。
+    """
+
+    def __init__(self, path, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self.changes = queue.Queue()
+        self._lock = threading.Lock()
+        # 監視スレッドと check_now() が同時に読み直して差分の順序が入れ替わらないようにする
+        self._poll_lock = threading.Lock()
+        self._generation = 0
+        self._signature = None
+        self._snapshot = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ledger-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def mark_synced(self, records, path=None):
+        """ファイルの内容が records と一致したことを記録する（アプリで保存・読み込みした直後に呼ぶ）"""
+        snapshot = [dict(record) for record in records]
+        with self._lock:
+            if path is not None:
+                self.path = path
+            self._generation += 1
+            self._signature = file_signature(self.path)
+            self._snapshot = snapshot
+
+    def check_now(self):
+        """ファイルが外部で更新されていれば、その場で読み直して差分を changes キューに入れる
+
+        保存の直前に呼び、まだ検知していない外部更新を上書きしないようにする。
+        監視スレッドが先に入れた差分より後ろに入るため、キューを順に反映すればよい。
+        読み込みに失敗した場合は例外をそのまま送出する。
+        """
+        self._poll()
+
+    def is_current(self, generation):
+        with self._lock:
+            return generation == self._generation
+
+    def _poll(self):
+        with self._poll_lock:
+            with self._lock:
+                path, generation = self.path, self._generation
+                known_signature, snapshot = self._signature, self._snapshot
+            signature = file_signature(path)
+            if signature is None or signature == known_signature:
+                return
+            records = core.load_inventory(path)
+            diff = core.diff_inventory(snapshot, records)
+            with self._lock:
+                if generation != self._generation:
+                    return  # 読み込み中にアプリ側で保存・読み込みが行われた
+                self._signature = signature
+                self._snapshot = records
+            if diff["added"] or diff["changed"] or diff["removed"]:
+                # 画面側のレコードとスナップショットを共有しないようにコピーして渡す
+                old_index = core.build_id_index(snapshot)
+                diff["base"] = {str(record["id"]): dict(old_index[str(record["id"])]) for record in diff["changed"]}
+                diff["added"] = [dict(record) for record in diff["added"]]
+                diff["changed"] = [dict(record) for record in diff["changed"]]
+                self.changes.put((generation, diff))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._poll()
+            except Exception as e:
+                # Excelで保存中などで読めない場合は次回に再試行する
+                print("台帳の再読み込みに失敗しました:", e)
@@ -0,0 +1,128 @@
+"""処理ステージごとの所要時間（ヒストグラム）とカウンタの計測"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# ヒストグラムのバケット境界（秒）
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)  # 最後は +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                index = i
+                break
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """バケットから分位点の上限値を概算する"""
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, n in zip(BUCKETS, self.bucket_counts):
+            cumulative += n
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """ステージ別のレイテンシとイベント数を保持する。複数スレッドから利用可能"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """with ブロックの所要時間を name のステージとして記録する。例外時は name.errors を加算"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(f"{name}.errors")
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def format_text(self):
+        """Prometheus のテキスト形式で出力する"""
+        lines = ["# TYPE inventory_stage_seconds histogram"]
+        with self._lock:
+            for stage in sorted(self.histograms):
+                hist = self.histograms[stage]
+                cumulative = 0
+                for bound, n in zip(BUCKETS, hist.bucket_counts):
+                    cumulative += n
+                    lines.append(f'inventory_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'inventory_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'inventory_stage_seconds_sum{{stage="{stage}"}} {hist.total:.6f}')
+                lines.append(f'inventory_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+            lines.append("# TYPE inventory_events_total counter")
+            for name in sorted(self.counters):
+                lines.append(f'inventory_events_total{{name="{name}"}} {self.counters[name]}')
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self):
+        """デバッグ表示用の1ステージ1行の要約"""
+        lines = [f"{'ステージ':<24}{'回数':>8}{'平均ms':>10}{'p95ms':>10}{'最大ms':>10}"]
+        with self._lock:
+            for stage in sorted(self.histograms):
+                hist = self.histograms[stage]
+                mean = hist.total / hist.count if hist.count else 0.0
+                lines.append(f"{stage:<24}{hist.count:>8}{mean * 1000:>10.1f}"
+                             f"{hist.quantile(0.95) * 1000:>10.1f}{hist.max * 1000:>10.1f}")
+            if self.counters:
+                lines.append("")
+                for name in sorted(self.counters):
+                    lines.append(f"{name:<24}{self.counters[name]:>8}")
+        return lines
+
+    def export(self, path):
+        """計測値をテキストファイルに書き出す（一時ファイル経由で置き換え）"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.format_text())
+        os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
+
+
+def timed(stage):
+    """関数の所要時間を METRICS に記録するデコレータ"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,248 @@
+"""保管場所ごとに分割した台帳（シャード）の読み書き
+
+シャード用フォルダには保管場所ごとのExcelファイルと、全品目のIDと保管場所を対応付けた
+directory.csv を置く。端末は担当の保管場所のシャードだけを読み込み、他の保管場所の品目は
+ID検索で必要になった時点でそのシャードを読み込む。保存は変更のあったシャードだけに行い、
+他の端末の更新を消さないよう、書き出す直前にシャードと directory.csv を読み直して変更行だけを反映する。
+
+既存の台帳を分割するには:
+    python sharded_ledger.py 台帳.xlsx シャード用フォルダ
+"""
+import hashlib
+import os
+import re
+import sys
+
+import inventory_core as core
+from lazy_imports import LazyModule
+
+pd = LazyModule("pandas")
+
+DIRECTORY_FILE = "directory.csv"
+
+
+def shard_path(shard_dir, location):
+    """保管場所のシャードファイルのパス
+
+    ファイル名に使えない文字は _ に置き換え、置き換えで同じ名前にならないよう保管場所名のハッシュを付ける。
+    """
+    safe_name = re.sub(r'[\\/:*?"<>|]', "_", location)
+    digest = hashlib.sha1(location.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(shard_dir, f"{safe_name}_{digest}.xlsx")
+
+
+def check_shard_paths(shard_dir, locations):
+    """異なる保管場所が同じシャードファイルになる場合は ValueError"""
+    paths = {}
+    for location in locations:
+        path = shard_path(shard_dir, location)
+        other = paths.setdefault(path, location)
+        if other != location:
+            raise ValueError(f"保管場所「{other}」と「{location}」のシャードファイルが重複します: {path}")
+
+
+def write_directory(shard_dir, directory):
+    path = os.path.join(shard_dir, DIRECTORY_FILE)
+    pd.DataFrame({"id": list(directory), "location": list(directory.values())}).to_csv(path, index=False)
+
+
+def read_directory(shard_dir):
+    """directory.csv を {ID: 保管場所} の辞書として読み込む"""
+    data = pd.read_csv(os.path.join(shard_dir, DIRECTORY_FILE), dtype=str, keep_default_na=False)
+    return dict(zip(data["id"], data["location"]))
+
+
+def split_ledger(excel_path, shard_dir):
+    """1つのExcel台帳を保管場所ごとのシャードとIDディレクトリに分割し、保管場所のリストを返す"""
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = {}
+    directory = {}
+    for item in core.load_inventory(excel_path):
+        location = core.item_location(item)
+        shards.setdefault(location, []).append(item)
+        directory.setdefault(str(item["id"]), location)
+    check_shard_paths(shard_dir, shards)
+    for location, records in shards.items():
+        core.save_inventory(shard_path(shard_dir, location), records)
+    write_directory(shard_dir, directory)
+    return sorted(shards)
+
+
+class ShardedLedger:
+    """保管場所ごとのシャードを必要な分だけ読み込む台帳
+
+    読み込んだレコードは呼び出し側の在庫リスト（inventory_data）に追加され、同じ辞書を共有する。
+    各行の最後にファイルと一致していた内容を覚えておき、保存時に他の端末の変更との重ね合わせに使う。
+    """
+
+    def __init__(self, shard_dir, local_locations=None):
+        self.shard_dir = shard_dir
+        self.local_locations = list(local_locations or [])
+        self.directory = {}
+        self.loaded_locations = set()
+        self._base = {}
+
+    def load_local(self):
+        """IDディレクトリと担当保管場所のシャードを読み込み、レコードのリストを返す（担当未指定なら全シャード）"""
+        self.directory = read_directory(self.shard_dir)
+        self.loaded_locations = set()
+        self._base = {}
+        locations = self.local_locations or sorted(set(self.directory.values()))
+        inventory_data = []
+        for location in locations:
+            self._load_into(inventory_data, location)
+        return inventory_data
+
+    def _load_into(self, inventory_data, location):
+        if location in self.loaded_locations:
+            return []
+        path = shard_path(self.shard_dir, location)
+        records = core.load_inventory(path) if os.path.exists(path) else []
+        self.loaded_locations.add(location)
+        self._remember(records)
+        inventory_data.extend(records)
+        return records
+
+    def _remember(self, records):
+        """records をファイルと一致している内容として記録する"""
+        for record in records:
+            self._base[str(record["id"])] = dict(record)
+
+    def load_for_ids(self, inventory_data, item_ids):
+        """未読み込みのシャードにある品目のシャードを読み込み、追加されたレコードを返す"""
+        item_ids = [str(item_id).strip() for item_id in item_ids]
+        if any(item_id not in self.directory for item_id in item_ids):
+            # 他の端末で登録された品目の可能性があるため、IDディレクトリを読み直す
+            self.directory.update(read_directory(self.shard_dir))
+        loaded = []
+        for item_id in item_ids:
+            location = self.directory.get(item_id)
+            if location is not None:
+                loaded.extend(self._load_into(inventory_data, location))
+        return loaded
+
+    def load_for_text(self, inventory_data, text):
+        """QRコードの文字列などに含まれるIDのシャードを読み込み、追加されたレコードを返す"""
+        item_id = next((item_id for item_id in self.directory if item_id in text), None)
+        return [] if item_id is None else self.load_for_ids(inventory_data, [item_id])
+
+    def save(self, inventory_data, touched_items=None):
+        """変更のあったレコードのシャードだけを書き出す
+
+        各シャードは書き出す直前にファイルから読み直し、touched_items の行だけをIDで差し替える。
+        touched_items の行が読み込み後に他の端末でも変更されていれば、この画面での変更を最新の行に重ね直す
+        （重ね直せない場合は何も書き出さずに core.LedgerConflictError）。
+        それ以外の行はファイル側（他の端末が保存した内容）を正とし、在庫リストにも反映する。
+        touched_items が None なら読み込み済みの全シャードを在庫リストの内容で書き出す。
+        在庫リストの内容が変わった（シャードを追加で読み込んだ・他の端末の更新を取り込んだ）場合は True を返す。
+        """
+        if touched_items is None:
+            check_shard_paths(self.shard_dir, self.loaded_locations)
+            for location in self.loaded_locations:
+                records = [item for item in inventory_data if core.item_location(item) == location]
+                core.save_inventory(shard_path(self.shard_dir, location), records)
+            self._save_directory({str(item["id"]): core.item_location(item) for item in inventory_data})
+            self._remember(item for item in inventory_data if core.item_location(item) in self.loaded_locations)
+            return False
+
+        touched_ids = {str(item["id"]) for item in touched_items}
+        touched = {}
+        for item in touched_items:
+            touched.setdefault(core.item_location(item), []).append(item)
+        for item in touched_items:
+            # 保管場所が変わった品目は元のシャードからも消す必要がある
+            previous = self.directory.get(str(item["id"]))
+            if previous is not None:
+                touched.setdefault(previous, [])
+        check_shard_paths(self.shard_dir, set(self.directory.values()) | set(touched))
+
+        disk = {}
+        for location in touched:
+            path = shard_path(self.shard_dir, location)
+            disk[location] = core.load_inventory(path) if os.path.exists(path) else []
+        latest_index = core.build_id_index([record for records in disk.values() for record in records])
+        rebased = []
+        for item in touched_items:
+            base = self._base.get(str(item["id"]))
+            latest = latest_index.get(str(item["id"]))
+            if base is not None and latest is not None:
+                rebased.append((item, core.rebase_record(base, item, latest)))
+
+        changed = False
+        for item, merged in rebased:
+            if merged != item:
+                item.update(merged)
+                changed = True
+        for location, items in touched.items():
+            path = shard_path(self.shard_dir, location)
+            disk_records = disk[location]
+            untouched = [record for record in disk_records if str(record["id"]) not in touched_ids]
+            if location in self.loaded_locations:
+                changed = self._refresh_from_disk(inventory_data, location, untouched, touched_ids) or changed
+            else:
+                # 未読み込みのシャードは、後で読み込んだときに重複しないようここで在庫リストに加える
+                inventory_data.extend(dict(record) for record in untouched)
+                self._remember(untouched)
+                self.loaded_locations.add(location)
+                changed = True
+
+            # ファイル上の並びを保ったまま、変更した行だけを差し替える
+            items_by_id = {str(item["id"]): item for item in items}
+            records = []
+            for record in disk_records:
+                record_id = str(record["id"])
+                if record_id in items_by_id:
+                    records.append(items_by_id.pop(record_id))
+                elif record_id not in touched_ids:
+                    records.append(record)
+            records.extend(items_by_id.values())
+            core.save_inventory(path, records)
+
+        self._save_directory({str(item["id"]): core.item_location(item) for item in touched_items})
+        self._remember(touched_items)
+        return changed
+
+    def _refresh_from_disk(self, inventory_data, location, disk_records, touched_ids):
+        """読み込み済みのシャードについて、保存しない行をファイルの内容に合わせる。変更があれば True"""
+        local = [item for item in inventory_data
+                 if core.item_location(item) == location and str(item["id"]) not in touched_ids]
+        diff = core.diff_inventory(local, disk_records)
+        if not (diff["added"] or diff["changed"] or diff["removed"]):
+            return False
+        index = core.build_id_index(local)
+        for record in diff["changed"]:
+            item = index[str(record["id"])]
+            # 発注中フラグは台帳に保存されないため、画面側の値を残す
+            pending = item.get("order_pending", False)
+            item.update(record)
+            if pending is True:
+                item["order_pending"] = True
+        inventory_data.extend(dict(record) for record in diff["added"])
+        self._remember(diff["changed"] + diff["added"])
+        if diff["removed"]:
+            removed = set(diff["removed"])
+            for item_id in removed:
+                self._base.pop(item_id, None)
+            inventory_data[:] = [item for item in inventory_data
+                                 if not (core.item_location(item) == location and str(item["id"]) in removed
+                                         and str(item["id"]) not in touched_ids)]
+        return True
+
+    def _save_directory(self, updates):
+        """他の端末の登録を消さないよう、directory.csv を読み直して変更分だけを反映して書き出す"""
+        changes = {item_id: location for item_id, location in updates.items()
+                   if self.directory.get(item_id) != location}
+        if not changes:
+            return
+        directory = read_directory(self.shard_dir)
+        directory.update(changes)
+        self.directory = directory
+        write_directory(self.shard_dir, directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    locations = split_ledger(sys.argv[1], sys.argv[2])
+    print(f"{len(locations)} 件の保管場所に分割しました: {', '.join(locations)}")
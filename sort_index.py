@@ -0,0 +1,130 @@
+"""在庫一覧の列ごとの並び順キャッシュと複数列の並べ替え"""
+import re
+
+import inventory_core as core
+from lazy_imports import LazyModule
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+NUMERIC_COLUMNS = ("quantity", "threshold")
+SORT_COLUMNS = ("id", "name", "category", "quantity", "location", "threshold")
+# ID中の数字部分をこの桁数までゼロ埋めして、文字列の比較で数値順（1, 2, 10, 11, 100）にする
+NATURAL_SORT_DIGITS = 20
+
+
+def natural_key(value):
+    """数字部分を数値として比較できるようにした並べ替え用の文字列"""
+    return re.sub(r"\d+", lambda m: m.group().zfill(NATURAL_SORT_DIGITS), str(value))
+
+
+def column_key(item, column):
+    """並べ替えに使う値（数値列は欠損を末尾に、IDは数字部分を数値順に、その他の列は表示と同じ文字列）"""
+    if column == "quantity":
+        return float(core.item_quantity(item))
+    if column == "threshold":
+        try:
+            value = item.get("threshold")
+            return float("inf") if value is None or pd.isna(value) else float(value)
+        except (TypeError, ValueError):
+            return float("inf")
+    if column == "category":
+        return core.item_category(item)
+    if column == "location":
+        return core.item_location(item)
+    if column == "id":
+        return natural_key(item.get("id"))
+    return str(item.get(column))
+
+
+class SortIndex:
+    """列ごとの argsort の結果をキャッシュし、複数列の並べ替えに使う
+
+    在庫リストが差し替えられたり件数が変わったりした場合はキャッシュを作り直す。
+    数量の変更などは update_item() で該当行の位置だけを移動して並び順を保つ。
+    """
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, inventory_data):
+        self._data = inventory_data
+        self._length = 0 if inventory_data is None else len(inventory_data)
+        self._keys = {}
+        self._orders = {}
+        self._ranks = {}
+        self._positions = None
+
+    def _ensure(self, inventory_data):
+        if inventory_data is not self._data or len(inventory_data) != self._length:
+            self.reset(inventory_data)
+
+    def _build_keys(self, column):
+        values = [column_key(item, column) for item in self._data]
+        if column in NUMERIC_COLUMNS:
+            return np.array(values, dtype=np.float64)
+        return np.array(values, dtype=np.str_) if values else np.array([], dtype=np.str_)
+
+    def order(self, inventory_data, column):
+        """column の昇順に並べた行位置の配列（同じ値は台帳の順）"""
+        self._ensure(inventory_data)
+        if column not in self._orders:
+            keys = self._build_keys(column)
+            self._keys[column] = keys
+            self._orders[column] = np.argsort(keys, kind="stable")
+        return self._orders[column]
+
+    def rank(self, inventory_data, column):
+        """各行の column の順位（同じ値は同じ順位）"""
+        order = self.order(inventory_data, column)
+        if column not in self._ranks:
+            sorted_keys = self._keys[column][order]
+            dense = np.zeros(len(order), dtype=np.int64)
+            if len(order) > 1:
+                dense[1:] = np.cumsum(sorted_keys[1:] != sorted_keys[:-1])
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = dense
+            self._ranks[column] = rank
+        return self._ranks[column]
+
+    def sorted_positions(self, inventory_data, sort_keys):
+        """sort_keys（(列名, 降順か) のリスト、先頭が第1キー）で並べた行位置の配列"""
+        if len(sort_keys) == 1 and not sort_keys[0][1]:
+            return self.order(inventory_data, sort_keys[0][0])
+        # lexsort は最後のキーを第1キーとして扱う
+        keys = [-self.rank(inventory_data, column) if descending else self.rank(inventory_data, column)
+                for column, descending in reversed(sort_keys)]
+        return np.lexsort(keys)
+
+    def update_item(self, inventory_data, item, columns=("quantity",)):
+        """item の値の変更をキャッシュ済みの並び順に反映する（全体の並べ替えはしない）"""
+        self._ensure(inventory_data)
+        if not self._orders:
+            return
+        if self._positions is None:
+            self._positions = {id(record): pos for pos, record in enumerate(self._data)}
+        pos = self._positions.get(id(item))
+        if pos is None:
+            return
+        for column in columns:
+            if column not in self._orders:
+                continue
+            keys = self._keys[column]
+            new_key = column_key(item, column)
+            if keys[pos] == new_key:
+                continue
+            if column not in NUMERIC_COLUMNS and len(new_key) > keys.dtype.itemsize // 4:
+                # 固定長の文字列配列に収まらない場合はこの列だけ作り直す
+                for cache in (self._keys, self._orders, self._ranks):
+                    cache.pop(column, None)
+                continue
+            order = self._orders[column]
+            order = order[order != pos]
+            keys[pos] = new_key
+            sorted_keys = keys[order]
+            lo = np.searchsorted(sorted_keys, new_key, side="left")
+            hi = np.searchsorted(sorted_keys, new_key, side="right")
+            # 同じ値の中では台帳の順を保つ
+            insert_at = lo + np.searchsorted(order[lo:hi], pos)
+            self._orders[column] = np.insert(order, insert_at, pos)
+            self._ranks.pop(column, None)
@@ -1,20 +1,51 @@
+import time
+STARTUP_TIME = time.perf_counter()
+
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
 from tkinter import ttk
-import pandas as pd
-import cv2
-from pyzbar.pyzbar import decode
-import qrcode
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import sys
+import queue
+import threading
 from dotenv import load_dotenv
+import inventory_core as core
+import lazy_imports
+from lazy_imports import LazyModule
+from metrics import METRICS, timed
+from ledger_watcher import LedgerWatcher
+from sharded_ledger import DIRECTORY_FILE, ShardedLedger
+from sort_index import SORT_COLUMNS, SortIndex
+
+# 起動を速くするため、重いモジュールは初回利用時（またはウィンドウ表示後の先読み）に読み込む
+pd = LazyModule("pandas")
+cv2 = LazyModule("cv2")
+pyzbar = LazyModule("pyzbar.pyzbar")
+qrcode = LazyModule("qrcode")
+smtplib = LazyModule("smtplib")
+mime_text = LazyModule("email.mime.text")
+mime_multipart = LazyModule("email.mime.multipart")
+PRELOAD_MODULES = ["pandas", "openpyxl", "smtplib", "email.mime.text", "email.mime.multipart",
+                   "cv2", "pyzbar.pyzbar", "qrcode"]
 
 env_loaded = load_dotenv()
 if not env_loaded:
     print(".envファイルの読み込みに失敗しました。デフォルト値を使用します。")
 
+def env_seconds(name, default):
+    """環境変数の秒数を読む。未設定・不正な値（数値でない・負・無限大）の場合は default"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1
+    if not 0 <= seconds < float("inf"):
+        print(f"環境変数 {name} の値が不正なため {default} 秒を使用します: {value}")
+        return default
+    return seconds
+
 class CenteredAskString(simpledialog.Dialog):
     def __init__(self, parent, title, prompt):
         self.prompt = prompt
@@ -50,6 +81,7 @@ def ask_centered_string(parent, title, prompt):
     dlg = CenteredAskString(parent, title, prompt)
     return dlg.result
 
+@timed("smtp")
 def send_low_stock_email_no_oauth(low_stock_items, sender_email_default, sender_password_default, recipient_email):
     # 環境変数から認証情報取得（設定されていない場合はデフォルト値を利用）
     sender_email = os.getenv("GMAIL_USER", sender_email_default)
@@ -61,11 +93,11 @@ def send_low_stock_email_no_oauth(low_stock_items, sender_email_default, sender_
         for item in low_stock_items
     ])
 
-    msg = MIMEMultipart()
+    msg = mime_multipart.MIMEMultipart()
     msg['From'] = sender_email
     msg['To'] = recipient_email
     msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'plain'))
+    msg.attach(mime_text.MIMEText(body, 'plain'))
 
     try:
         server = smtplib.SMTP('smtp.gmail.com', 587, timeout=5)
@@ -73,8 +105,10 @@ def send_low_stock_email_no_oauth(low_stock_items, sender_email_default, sender_
         server.login(sender_email, sender_password)
         server.sendmail(sender_email, recipient_email, msg.as_string())
         server.quit()
+        METRICS.increment("email.sent")
         print("在庫不足通知メールを送信しました。")
     except Exception as e:
+        METRICS.increment("email.failed")
         print("メール送信に失敗しました:", e)
 
 def ask_integer_modal(parent, title, prompt, minvalue=1):
@@ -137,30 +171,40 @@ class InventoryApp:
     def __init__(self, root):
         self.root = root
         self.root.title("在庫管理アプリ")
-        self.root.geometry("1000x400")
+        self.root.geometry("1200x400")
         
         # 認証情報およびメール設定を環境変数から取得（未設定の場合はデフォルト値を設定）
         self.admin_password = os.getenv("ADMIN_PASSWORD", "default_admin")
         self.sender_email = os.getenv("GMAIL_USER", "default_sender@example.com")
         self.sender_password = os.getenv("GMAIL_APP_PASSWORD", "default_app_password")
         self.recipient_email = os.getenv("RECIPIENT_EMAIL", "default_recipient@example.com")
-        
-        if not os.path.exists(self.EXCEL_FILE):
-            messagebox.showerror("読み込みエラー", f"指定したExcelファイルが存在しません: {self.EXCEL_FILE}")
-            self.root.destroy()
-            return
 
-        try:
-            df = pd.read_excel(self.EXCEL_FILE)
-            self.inventory_data = df.to_dict("records")
-            for item in self.inventory_data:
-                if "threshold" not in item or pd.isna(item["threshold"]):
-                    item["threshold"] = 5
-        except Exception as e:
-            messagebox.showerror("読み込みエラー", f"Excelファイルの読み込みに失敗しました: {e}")
+        # LEDGER_SHARD_DIR を指定すると保管場所ごとに分割した台帳を使い、
+        # LOCAL_LOCATIONS（カンマ区切り）の保管場所だけを起動時に読み込む
+        self.sharded_ledger = None
+        shard_dir = os.getenv("LEDGER_SHARD_DIR")
+        if shard_dir:
+            if not os.path.exists(os.path.join(shard_dir, DIRECTORY_FILE)):
+                messagebox.showerror("読み込みエラー", f"指定したシャード台帳のフォルダにIDディレクトリがありません: {shard_dir}")
+                self.root.destroy()
+                return
+            local_locations = [loc.strip() for loc in os.getenv("LOCAL_LOCATIONS", "").split(",") if loc.strip()]
+            self.sharded_ledger = ShardedLedger(shard_dir, local_locations)
+        elif not os.path.exists(self.EXCEL_FILE):
+            messagebox.showerror("読み込みエラー", f"指定したExcelファイルが存在しません: {self.EXCEL_FILE}")
             self.root.destroy()
             return
 
+        # 台帳はウィンドウ表示後にバックグラウンドで読み込む（読み込み完了まで操作ボタンは無効）
+        self.inventory_data = []
+        self.ledger_queue = queue.Queue()
+        self.ledger_watcher = None
+        # 保存処理中の（この画面で変更してまだ保存していない）レコード
+        self.pending_items = []
+        self.tree_iids = {}
+        # 並べ替え条件（(列名, 降順か) のリスト、先頭が第1キー）と列ごとの並び順キャッシュ
+        self.sort_keys = []
+        self.sort_index = SortIndex()
         self.cancel_qr = False
 
         # 追加: フィルタ用変数を初期化
@@ -186,6 +230,9 @@ class InventoryApp:
         self.inventory_tree.column("quantity", width=50, anchor="center")
         self.inventory_tree.column("location", width=150)
         self.inventory_tree.column("threshold", width=50, anchor="center")
+        self.column_labels = {col: self.inventory_tree.heading(col, "text") for col in SORT_COLUMNS}
+        # 見出しクリックで並べ替え（Shift+クリックで並べ替えキーを追加）
+        self.inventory_tree.bind("<Button-1>", self.on_tree_click)
         self.inventory_tree.pack(side="left", fill="both", expand=True)
         scrollbar = ttk.Scrollbar(self.tree_frame, orient="vertical", command=self.inventory_tree.yview)
         self.inventory_tree.configure(yscrollcommand=scrollbar.set)
@@ -222,7 +269,230 @@ class InventoryApp:
         self.button_frame = tk.Frame(root)
         self.button_frame.grid(row=1, column=0, columnspan=2, padx=10, pady=10, sticky="w")
         self.create_buttons()
+        self.set_action_buttons_state("disabled")
+        self.root.title("在庫管理アプリ（台帳読み込み中…）")
+        self.update_inventory_display()
+
+        # 計測値の定期書き出し（METRICS_FILE 設定時）と F12 で計測パネル表示
+        self.metrics_file = os.getenv("METRICS_FILE")
+        self.metrics_interval_ms = int(env_seconds("METRICS_EXPORT_INTERVAL", 30) * 1000)
+        if self.metrics_file and self.metrics_interval_ms > 0:
+            self.root.after(self.metrics_interval_ms, self.export_metrics)
+        self.root.bind("<F12>", lambda event: self.open_metrics_panel())
+
+        self.root.after_idle(self.start_background_load)
+
+    def start_background_load(self):
+        """ウィンドウ表示後に、台帳の読み込みと重いモジュールの先読みを開始する"""
+        METRICS.observe("startup.window_shown", time.perf_counter() - STARTUP_TIME)
+        self.preload_thread = lazy_imports.preload(PRELOAD_MODULES)
+        self.load_ledger_in_background(initial=True)
+
+    def load_ledger_in_background(self, path=None, initial=False):
+        """台帳を別スレッドで読み込む。読み込み中は操作ボタンを無効にする"""
+        path = path or self.EXCEL_FILE
+        self.set_action_buttons_state("disabled")
+        self.root.title("在庫管理アプリ（台帳読み込み中…）")
+        threading.Thread(target=self._load_ledger_worker, args=(path,), daemon=True).start()
+        self.root.after(50, lambda: self.poll_ledger_load(path, initial))
+
+    def _load_ledger_worker(self, path):
+        # 別スレッドで実行されるため、Tkには触れず結果をキューに渡すだけにする
+        try:
+            if self.sharded_ledger is not None:
+                self.ledger_queue.put(("ok", self.sharded_ledger.load_local()))
+            else:
+                self.ledger_queue.put(("ok", core.load_inventory(path)))
+        except Exception as e:
+            self.ledger_queue.put(("error", e))
+
+    def poll_ledger_load(self, path, initial=False):
+        """台帳の読み込み完了を待ち、完了したら画面に反映する（失敗時は元の台帳のまま）"""
+        try:
+            status, result = self.ledger_queue.get_nowait()
+        except queue.Empty:
+            self.root.after(50, lambda: self.poll_ledger_load(path, initial))
+            return
+        if status == "error":
+            messagebox.showerror("読み込みエラー", f"Excelファイルの読み込みに失敗しました: {result}")
+            if initial:
+                self.root.destroy()
+                return
+        else:
+            self.EXCEL_FILE = path
+            self.inventory_data = result
+            self.update_category_checkboxes()
+            self.update_location_checkboxes()
+            self.update_inventory_display()
+            self.start_ledger_watcher()
+        self.set_action_buttons_state("normal")
+        self.root.title("在庫管理アプリ")
+        if not initial:
+            return
+        METRICS.observe("startup.ledger_ready", time.perf_counter() - STARTUP_TIME)
+        if "--import-report" in sys.argv or os.getenv("IMPORT_TIME_REPORT"):
+            self.print_import_report()
+
+    def start_ledger_watcher(self):
+        """台帳ファイルの外部更新の監視を開始する（LEDGER_WATCH_INTERVAL 秒ごと、0で無効）"""
+        interval = env_seconds("LEDGER_WATCH_INTERVAL", 2)
+        if interval <= 0 or self.sharded_ledger is not None:
+            # シャード台帳は複数ファイルに分かれるため監視の対象外
+            return
+        if self.ledger_watcher is None:
+            self.ledger_watcher = LedgerWatcher(self.EXCEL_FILE, interval)
+            self.ledger_watcher.mark_synced(self.inventory_data)
+            self.ledger_watcher.start()
+            self.root.after(500, self.poll_ledger_changes)
+        else:
+            self.ledger_watcher.mark_synced(self.inventory_data, path=self.EXCEL_FILE)
+
+    def poll_ledger_changes(self, reschedule=True):
+        """外部更新の差分があれば反映する"""
+        # 保存処理の確認ダイアログ表示中は、保存処理の中で反映するためキューに残しておく
+        while not (reschedule and self.pending_items):
+            try:
+                generation, diff = self.ledger_watcher.changes.get_nowait()
+            except queue.Empty:
+                break
+            if self.ledger_watcher.is_current(generation):
+                self.apply_ledger_diff(diff, self.pending_items)
+        if reschedule:
+            self.root.after(500, self.poll_ledger_changes)
+
+    def merge_external_changes(self, touched_items=None):
+        """保存の直前に、まだ反映していない外部更新を取り込む。保存を続けてよければ True
+
+        touched_items の行が外部でも変更されていれば、この画面での変更を最新の行に重ね直す。
+        重ね直せない場合は core.LedgerConflictError。
+        """
+        self.pending_items = list(touched_items or [])
+        try:
+            try:
+                self.ledger_watcher.check_now()
+            except Exception as e:
+                # Excelで開いたまま保存中などで読めない場合は、上書きしてよいか確認する
+                if not messagebox.askyesno(
+                        "外部更新の確認",
+                        f"台帳ファイルが外部で更新されていますが、読み込めませんでした: {e}\n"
+                        "外部での変更を破棄して上書き保存しますか？"):
+                    return False
+            # check_now() の差分は監視スレッドが先に入れた差分の後ろに入るため、キューを順に反映すればよい
+            self.poll_ledger_changes(reschedule=False)
+            return True
+        finally:
+            self.pending_items = []
+
+    @timed("external_reload")
+    def apply_ledger_diff(self, diff, pending_items=()):
+        """外部で変更された行だけを在庫データと表示に反映する
+
+        pending_items（この画面で変更してまだ保存していないレコード）は、外部での変更の上にこの画面での変更を重ね直す。
+        重ね直せない行があれば何も変更せずに core.LedgerConflictError。
+        """
+        index = core.build_id_index(self.inventory_data)
+        pending_ids = {str(item["id"]) for item in pending_items}
+        rebased = {}
+        for record in diff["changed"]:
+            item_id = str(record["id"])
+            if item_id in pending_ids and item_id in index:
+                rebased[item_id] = core.rebase_record(diff["base"][item_id], index[item_id], record)
+        cats_before = {core.item_category(item) for item in self.inventory_data}
+        locs_before = {core.item_location(item) for item in self.inventory_data}
+
+        changed_items = []
+        for record in diff["changed"]:
+            item = index.get(str(record["id"]))
+            if item is None:
+                continue
+            if str(record["id"]) in rebased:
+                item.update(rebased[str(record["id"])])
+            else:
+                # 発注中フラグは発注時には保存しないため、画面側で立てたものを残す
+                pending = item.get("order_pending", False)
+                item.update(record)
+                if pending is True:
+                    item["order_pending"] = True
+            self.sort_index.update_item(self.inventory_data, item, columns=SORT_COLUMNS)
+            changed_items.append(item)
+        for record in diff["added"]:
+            if str(record["id"]) not in index:
+                self.inventory_data.append(record)
+        if diff["removed"]:
+            removed = set(diff["removed"]) - pending_ids
+            self.inventory_data = [item for item in self.inventory_data if str(item["id"]) not in removed]
+
+        cats_after = {core.item_category(item) for item in self.inventory_data}
+        locs_after = {core.item_location(item) for item in self.inventory_data}
+        if cats_after != cats_before:
+            self.update_category_checkboxes()
+        if locs_after != locs_before:
+            self.update_location_checkboxes()
+
+        if (diff["added"] or diff["removed"] or cats_after != cats_before or locs_after != locs_before
+                or self.sort_keys):
+            self.update_inventory_display()
+        else:
+            self.refresh_inventory_rows(changed_items)
+        print(f"台帳の外部更新を反映しました（追加 {len(diff['added'])}・変更 {len(diff['changed'])}・削除 {len(diff['removed'])} 行）")
+
+    def refresh_inventory_rows(self, items):
+        """指定したレコードの行だけを更新する。フィルタの該当有無が変わった場合は全体を再表示"""
+        selected_categories, selected_locations = self.selected_filters()
+        for item in items:
+            iid = self.tree_iids.get(id(item))
+            visible = bool(core.filter_inventory([item], selected_categories, selected_locations))
+            if (iid is not None) != visible:
+                self.update_inventory_display()
+                return
+            if iid is not None:
+                self.inventory_tree.item(iid, values=core.inventory_row_values(item))
+
+    def find_item(self, item_id):
+        """IDで品目を探す。シャード台帳では未読み込みの保管場所のシャードも必要に応じて読み込む"""
+        item = core.find_item_by_id(self.inventory_data, item_id)
+        if item is None and self.sharded_ledger is not None:
+            if self.sharded_ledger.load_for_ids(self.inventory_data, [item_id]):
+                self.on_shard_loaded()
+                item = core.find_item_by_id(self.inventory_data, item_id)
+        return item
+
+    def find_item_in_qr(self, qr_data):
+        """QRコードの文字列から品目を探す（シャード台帳では find_item と同様に追加読み込みする）"""
+        item = core.find_item_in_qr(self.inventory_data, qr_data)
+        if item is None and self.sharded_ledger is not None:
+            if self.sharded_ledger.load_for_text(self.inventory_data, qr_data):
+                self.on_shard_loaded()
+                item = core.find_item_in_qr(self.inventory_data, qr_data)
+        return item
+
+    def load_shards_for_ids(self, item_ids):
+        """一括処理の前に、明細のIDが属するシャードをまとめて読み込む"""
+        if self.sharded_ledger is not None and self.sharded_ledger.load_for_ids(self.inventory_data, item_ids):
+            self.on_shard_loaded()
+
+    def on_shard_loaded(self):
+        """シャードの読み込みや他の端末の更新の取り込みで在庫リストが変わったときに画面を作り直す"""
+        # 行の値が書き換わっても件数が変わらない場合があるため、並び順のキャッシュも捨てる
+        self.sort_index.reset(None)
+        self.update_category_checkboxes()
+        self.update_location_checkboxes()
         self.update_inventory_display()
+
+    def print_import_report(self):
+        """起動時間とモジュール読み込み時間を表示する（先読みの完了を待ってから出力）"""
+        if self.preload_thread.is_alive():
+            self.root.after(200, self.print_import_report)
+            return
+        print("---- 起動時間レポート ----")
+        summary = METRICS.summary_lines()
+        print(summary[0])
+        for line in summary[1:]:
+            if line.startswith("startup."):
+                print(line)
+        print("---- モジュール読み込み時間 ----")
+        for line in lazy_imports.import_report():
+            print(line)
         
     def show_all_items(self):
         """全表示ボタン用：フィルターを無視してすべて表示"""
@@ -232,42 +502,66 @@ class InventoryApp:
             var.set(0)
         self.update_inventory_display()
 
+    @timed("display_refresh")
     def update_inventory_display(self):
         """Treeviewの内容をクリアし、フィルタに応じた在庫表示を更新"""
         self.filtered_inventory = []
+        self.tree_iids = {}
         for row in self.inventory_tree.get_children():
             self.inventory_tree.delete(row)
 
-        # 選択中のフィルター条件を取得
+        selected_categories, selected_locations = self.selected_filters()
+        inventory_data = self.inventory_data
+        if self.sort_keys:
+            with METRICS.stage("sort"):
+                positions = self.sort_index.sorted_positions(self.inventory_data, self.sort_keys).tolist()
+                inventory_data = [self.inventory_data[pos] for pos in positions]
+        self.filtered_inventory = core.filter_inventory(inventory_data, selected_categories, selected_locations)
+        for item in self.filtered_inventory:
+            # レコードごとの行IDを覚えておき、外部更新時に行単位で書き換えられるようにする
+            self.tree_iids[id(item)] = self.inventory_tree.insert("", "end", values=core.inventory_row_values(item))
+
+    def on_tree_click(self, event):
+        if self.inventory_tree.identify_region(event.x, event.y) != "heading":
+            return
+        column = self.inventory_tree.column(self.inventory_tree.identify_column(event.x), "id")
+        self.toggle_sort(column, add=bool(event.state & 0x0001))  # Shiftキー
+
+    def toggle_sort(self, column, add=False):
+        """見出しクリック時の並べ替え条件の切り替え（昇順→降順→解除）
+
+        add が真なら既存の条件に column を追加し、既にあれば昇順/降順を切り替える。
+        """
+        keys = list(self.sort_keys)
+        current = next((i for i, (col, _) in enumerate(keys) if col == column), None)
+        if add:
+            if current is None:
+                keys.append((column, False))
+            else:
+                keys[current] = (column, not keys[current][1])
+        elif len(keys) == 1 and current == 0:
+            keys = [] if keys[0][1] else [(column, True)]
+        else:
+            keys = [(column, False)]
+        self.sort_keys = keys
+        self.update_sort_headings()
+        self.update_inventory_display()
+
+    def update_sort_headings(self):
+        """見出しに並べ替えの向き（▲▼）と優先順位を表示する"""
+        for col, label in self.column_labels.items():
+            self.inventory_tree.heading(col, text=label)
+        for priority, (col, descending) in enumerate(self.sort_keys, start=1):
+            mark = "▼" if descending else "▲"
+            if len(self.sort_keys) > 1:
+                mark += str(priority)
+            self.inventory_tree.heading(col, text=f"{self.column_labels[col]} {mark}")
+
+    def selected_filters(self):
+        """選択中のカテゴリと保管場所のリストを返す"""
         selected_categories = [cat for cat, var in self.category_vars.items() if var.get() == 1]
         selected_locations = [loc for loc, var in self.location_vars.items() if var.get() == 1]
-
-        for item in self.inventory_data:
-            # itemのカテゴリと保管場所（空の場合は"未設定"）
-            item_cat = str(item.get("category") or "未設定")
-            item_loc = str(item.get("location") or "未設定")
-
-            if selected_categories and (item_cat not in selected_categories):
-                continue
-
-            if selected_locations and (item_loc not in selected_locations):
-                continue
-
-            try:
-                quantity = 0 if pd.isna(item['quantity']) else int(item['quantity'])
-            except Exception:
-                quantity = 0
-            threshold = item.get("threshold")
-            if threshold is None or pd.isna(threshold):
-                threshold = "未設定"
-            # 発注中なら商品名の前に【発注中】を表示
-            name_to_show = item["name"]
-            if item.get("order_pending", False):
-                name_to_show = "【発注中】" + name_to_show
-
-            self.filtered_inventory.append(item)
-            self.inventory_tree.insert("", "end", values=(
-                item["id"], name_to_show, item["category"], quantity, item_loc, threshold))
+        return selected_categories, selected_locations
 
     def update_category_checkboxes(self, in_frame_only=False):
         # 既存のウィジェットをクリア
@@ -294,7 +588,7 @@ class InventoryApp:
         scrollbar.pack(side="right", fill="y")
         
         self.category_vars.clear()
-        cats = {str(item.get("category") or "未設定") for item in self.inventory_data}
+        cats = {core.item_category(item) for item in self.inventory_data}
         for cat in sorted(cats):
             var = tk.IntVar(value=0)
             self.category_vars[cat] = var
@@ -326,7 +620,7 @@ class InventoryApp:
         scrollbar.pack(side="right", fill="y")
         
         self.location_vars.clear()
-        locs = {str(item.get("location") or "未設定") for item in self.inventory_data}
+        locs = {core.item_location(item) for item in self.inventory_data}
         for loc in sorted(locs):
             var = tk.IntVar(value=0)
             self.location_vars[loc] = var
@@ -360,7 +654,9 @@ class InventoryApp:
         tk.Label(cancel_window, text="QRコード読み取り中です…").pack(padx=10, pady=10)
         tk.Button(cancel_window, text="キャンセル", command=lambda: self.cancel_qr_button(cancel_window)).pack(pady=10)
 
-        cap = cv2.VideoCapture(1)
+        scan_start = time.perf_counter()
+        with METRICS.stage("qr.camera_open"):
+            cap = cv2.VideoCapture(1)
         qr_result = None
         self.cancel_qr = False
 
@@ -368,15 +664,21 @@ class InventoryApp:
             if self.cancel_qr:
                 break
 
-            ret, frame = cap.read()
+            with METRICS.stage("qr.frame_read"):
+                ret, frame = cap.read()
             if not ret:
                 break
+            METRICS.increment("qr.frames")
 
             cv2.putText(frame, "EXIT Esc or q", (10, 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
 
-            for obj in decode(frame):
+            with METRICS.stage("qr.decode"):
+                decoded = pyzbar.decode(frame)
+            for obj in decoded:
                 qr_result = obj.data.decode("utf-8")
+                METRICS.observe("qr.scan_to_decode", time.perf_counter() - scan_start)
+                METRICS.increment("qr.decoded")
                 messagebox.showinfo("QRコード読み取り", f"QRコードデータ: {qr_result}")
                 self.cancel_qr = True
                 break
@@ -401,7 +703,7 @@ class InventoryApp:
             return
         item_values = self.inventory_tree.item(selected[0], "values")
         selected_id = item_values[0]
-        selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(selected_id)), None)
+        selected_item = core.find_item_by_id(self.inventory_data, selected_id)
         if not selected_item:
             messagebox.showerror("QRコード生成エラー", f"選択された品番が見つかりません: {selected_id}")
             return
@@ -429,34 +731,17 @@ class InventoryApp:
         if not filepath:
             return
         try:
-            # ファイル拡張子によって読み込み方法を切り替える
-            if filepath.lower().endswith(('.xlsx', '.xls')):
-                data = pd.read_excel(filepath)
-            else:
-                data = pd.read_csv(filepath)
-            
-            required = ['id', 'name', 'category', 'quantity', 'location', 'threshold', 'order_pending']
-            missing = [col for col in required if col not in data.columns]
-            if missing:
-                messagebox.showerror("CSVエラー", f"次の列が不足しています: {', '.join(missing)}")
+            try:
+                records = core.read_import_file(filepath)
+            except ValueError as e:
+                messagebox.showerror("CSVエラー", str(e))
                 return
-            
-            for _, row in data.iterrows():
-                self.inventory_data.append({
-                    "id": row['id'],
-                    "name": row['name'],
-                    "category": row['category'],
-                    "quantity": row['quantity'],
-                    "location": row['location'],
-                    "threshold": row['threshold'],
-                    # order_pending 列が存在するかチェックし、欠損値の場合は False を設定
-                    "order_pending": row['order_pending'] if not pd.isna(row.get('order_pending', False)) else False
-                })
+            self.inventory_data.extend(records)
             messagebox.showinfo("CSVインポート", "CSV/Excelファイルのインポートが成功しました！")
             self.update_inventory_display()
             self.update_category_checkboxes()
             self.update_location_checkboxes()
-            self.save_inventory_to_excel()
+            self.save_inventory_to_excel(records)
         except Exception as e:
             messagebox.showerror("CSVインポートエラー", f"エラーが発生しました: {e}")
 
@@ -467,20 +752,23 @@ class InventoryApp:
             qr_data = self.read_qr_code()
             if not qr_data:
                 return messagebox.showwarning("QRコードエラー", "QRコードの読み取りに失敗しました。")
-            selected_item = next((item for item in self.inventory_data if str(item["id"]) in qr_data), None)
+            with METRICS.stage("lookup"):
+                selected_item = self.find_item_in_qr(qr_data)
             if not selected_item:
                 return messagebox.showerror("品番エラー", "QRコードに対応する品番が見つかりません。")
         else:
             selected = self.inventory_tree.selection()
             if selected:
                 item_values = self.inventory_tree.item(selected[0], "values")
-                selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(item_values[0])), None)
+                with METRICS.stage("lookup"):
+                    selected_item = core.find_item_by_id(self.inventory_data, item_values[0])
             else:
                 # 直接手動入力に切り替える
                 entered_id = ask_centered_string(self.root, "ID入力", "入庫する商品のIDを入力してください:")
                 if not entered_id:
                     return
-                selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(entered_id)), None)
+                with METRICS.stage("lookup"):
+                    selected_item = self.find_item(entered_id)
                 if not selected_item:
                     return messagebox.showerror("品番エラー", "入力されたIDに対応する品番が見つかりません。")
 
@@ -492,16 +780,12 @@ class InventoryApp:
         if not ok:
             return
 
-        try:
-            current_qty = int(selected_item.get("quantity", 0))
-            selected_item["quantity"] = current_qty + add_qty
-            if selected_item.get("order_pending", False):
-                selected_item["order_pending"] = False
-        except Exception:
-            selected_item["quantity"] = add_qty
+        core.apply_stock_in(selected_item, add_qty)
+        self.sort_index.update_item(self.inventory_data, selected_item)
 
         self.update_inventory_display()
-        self.save_inventory_to_excel()
+        if not self.save_inventory_to_excel([selected_item]):
+            return
         messagebox.showinfo("入庫完了", f"{selected_item['name']} を {add_qty} 個 入庫しました。")
         self.record_log("入庫", selected_item, add_qty)
 
@@ -512,20 +796,23 @@ class InventoryApp:
             qr_data = self.read_qr_code()
             if not qr_data:
                 return messagebox.showwarning("QRコードエラー", "QRコードの読み取りに失敗しました。")
-            selected_item = next((item for item in self.inventory_data if str(item["id"]) in qr_data), None)
+            with METRICS.stage("lookup"):
+                selected_item = self.find_item_in_qr(qr_data)
             if not selected_item:
                 return messagebox.showerror("品番エラー", "QRコードに対応する品番が見つかりません。")
         else:
             selected = self.inventory_tree.selection()
             if selected:
                 item_values = self.inventory_tree.item(selected[0], "values")
-                selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(item_values[0])), None)
+                with METRICS.stage("lookup"):
+                    selected_item = core.find_item_by_id(self.inventory_data, item_values[0])
             else:
                 # 直接手動入力に切り替える
                 entered_id = ask_centered_string(self.root, "ID入力", "出庫する商品のIDを入力してください:")
                 if not entered_id:
                     return
-                selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(entered_id)), None)
+                with METRICS.stage("lookup"):
+                    selected_item = self.find_item(entered_id)
                 if not selected_item:
                     return messagebox.showerror("品番エラー", "入力されたIDに対応する品番が見つかりません。")
 
@@ -534,25 +821,228 @@ class InventoryApp:
             return
 
         try:
-            current_qty = int(selected_item.get("quantity", 0))
-        except Exception:
-            current_qty = 0
-        if remove_qty > current_qty:
-            return messagebox.showerror("数量エラー", "出庫数量が在庫数量を超えています。")
+            core.apply_stock_out(selected_item, remove_qty)
+        except ValueError as e:
+            return messagebox.showerror("数量エラー", str(e))
+        self.sort_index.update_item(self.inventory_data, selected_item)
 
-        selected_item["quantity"] = current_qty - remove_qty
         self.update_inventory_display()
-        self.save_inventory_to_excel()
+        if not self.save_inventory_to_excel([selected_item]):
+            return
         self.check_low_stock()
         messagebox.showinfo("出庫完了", f"{selected_item['name']} を {remove_qty} 個 出庫しました。")
         self.record_log("出庫", selected_item, -remove_qty)
 
-    def save_inventory_to_excel(self):
+    def open_batch_movements(self):
+        """ピッキングリスト（id, qty, direction のCSV）を貼り付けまたはファイルから読み込み、一括で入出庫する"""
+        win = tk.Toplevel(self.root)
+        win.title("一括入出庫")
+        tk.Label(win, text="ピッキングリストを貼り付けてください（1行目: id,qty,direction / direction は in または out）")\
+            .pack(anchor="w", padx=10, pady=(10, 0))
+        text = tk.Text(win, width=60, height=15)
+        text.pack(padx=10, pady=10, fill="both", expand=True)
+        text.insert("1.0", "id,qty,direction\n")
+
+        def run(load_movements):
+            try:
+                movements = load_movements()
+            except Exception as e:
+                messagebox.showerror("一括入出庫エラー", f"ピッキングリストを読み込めません: {e}", parent=win)
+                return
+            if self.apply_stock_movements(movements, parent=win):
+                win.destroy()
+
+        def run_file():
+            filepath = filedialog.askopenfilename(parent=win, filetypes=[("CSV Files", "*.csv"), ("Excel Files", "*.xlsx;*.xls")])
+            if filepath:
+                run(lambda: core.read_picking_list(filepath))
+
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(pady=5)
+        tk.Button(btn_frame, text="実行", width=15,
+                  command=lambda: run(lambda: core.parse_picking_list(text.get("1.0", tk.END)))).pack(side="left", padx=5)
+        tk.Button(btn_frame, text="ファイルから実行", width=15, command=run_file).pack(side="left", padx=5)
+        tk.Button(btn_frame, text="閉じる", width=15, command=win.destroy).pack(side="left", padx=5)
+
+    def apply_stock_movements(self, movements, parent=None):
+        """明細をすべて検証してから一括で反映し、表示更新・保存・在庫不足チェックを1回ずつ行う"""
+        if not movements:
+            messagebox.showwarning("一括入出庫", "明細がありません。", parent=parent)
+            return False
+        self.load_shards_for_ids([movement.get("id") for movement in movements])
+        try:
+            with METRICS.stage("batch_validate"):
+                resolved = core.validate_movements(self.inventory_data, movements)
+        except core.MovementError as e:
+            messagebox.showerror("一括入出庫エラー", f"以下の明細に誤りがあるため、何も反映していません:\n{e}", parent=parent)
+            return False
+
+        in_count = sum(1 for _, _, direction in resolved if direction == "in")
+        out_count = len(resolved) - in_count
+        ok = messagebox.askyesno("確認", f"入庫 {in_count} 件、出庫 {out_count} 件を反映します。よろしいですか？", parent=parent)
+        if not ok:
+            return False
+
+        # 確認ダイアログの表示中に外部更新が反映されている場合があるため、反映の直前に検証し直す
         try:
-            pd.DataFrame(self.inventory_data).to_excel(self.EXCEL_FILE, index=False)
+            resolved = core.apply_movements(self.inventory_data, movements)
+        except core.MovementError as e:
+            messagebox.showerror("一括入出庫エラー", f"確認中に台帳が更新されたため、何も反映していません:\n{e}", parent=parent)
+            return False
+        for item, _, _ in resolved:
+            self.sort_index.update_item(self.inventory_data, item)
+        self.update_inventory_display()
+        if not self.save_inventory_to_excel([item for item, _, _ in resolved]):
+            return False
+        if out_count:
+            self.check_low_stock()
+        for item, qty, direction in resolved:
+            if direction == "in":
+                self.record_log("入庫", item, qty)
+            else:
+                self.record_log("出庫", item, -qty)
+        messagebox.showinfo("一括入出庫完了", f"{len(resolved)} 件の入出庫を反映しました。", parent=parent)
+        return True
+
+    def open_stocktake(self):
+        """棚卸モード：QRスキャンまたは棚卸表で実棚数を集め、台帳との差異を確認して一括で反映する"""
+        win = tk.Toplevel(self.root)
+        win.title("棚卸")
+        win.geometry("700x450")
+        scanned_counts = {}
+        state = {"variances": None}
+
+        top_frame = tk.Frame(win)
+        top_frame.pack(fill="x", padx=10, pady=10)
+        count_label = tk.Label(top_frame, text="スキャン済み: 0 品目")
+
+        tree_frame = tk.Frame(win)
+        tree_frame.pack(fill="both", expand=True, padx=10)
+        columns = ("id", "name", "location", "quantity", "counted", "variance")
+        tree = ttk.Treeview(tree_frame, columns=columns, show="headings", selectmode="extended")
+        for col, label, width in [("id", "ID", 60), ("name", "商品名", 150), ("location", "保管場所", 120),
+                                  ("quantity", "台帳数量", 70), ("counted", "実棚数", 70), ("variance", "差異", 70)]:
+            tree.heading(col, text=label)
+            tree.column(col, width=width, anchor="w" if col in ("name", "location") else "center")
+        tree.pack(side="left", fill="both", expand=True)
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+
+        def show_variances(counts):
+            self.load_shards_for_ids(counts["id"])
+            with METRICS.stage("stocktake_diff"):
+                variances, unknown_ids = core.compute_stock_variances(self.inventory_data, counts)
+            state["variances"] = variances
+            tree.delete(*tree.get_children())
+            for row in variances.itertuples(index=False):
+                tree.insert("", "end", iid=row.id, values=(row.id, row.name, row.location,
+                                                         row.quantity, row.counted, row.variance))
+            if unknown_ids:
+                messagebox.showwarning("棚卸", "台帳に無いIDは除外しました:\n" + ", ".join(unknown_ids[:20]), parent=win)
+            if variances.empty:
+                messagebox.showinfo("棚卸", "差異はありません。", parent=win)
+
+        def scan_counts():
+            while True:
+                qr_data = self.read_qr_code()
+                if not qr_data:
+                    break
+                item = self.find_item_in_qr(qr_data)
+                if not item:
+                    messagebox.showerror("品番エラー", "QRコードに対応する品番が見つかりません。", parent=win)
+                    continue
+                counted = ask_integer_modal(win, "実棚数", f"{item['name']} の実棚数を入力してください", minvalue=0)
+                if counted is not None:
+                    scanned_counts[str(item["id"])] = counted
+                    count_label.config(text=f"スキャン済み: {len(scanned_counts)} 品目")
+                if not messagebox.askyesno("棚卸", "続けてスキャンしますか？", parent=win):
+                    break
+
+        def compare_scanned():
+            if not scanned_counts:
+                messagebox.showwarning("棚卸", "スキャン済みの品目がありません。", parent=win)
+                return
+            show_variances(core.counts_frame(scanned_counts))
+
+        def load_count_sheet():
+            filepath = filedialog.askopenfilename(parent=win, filetypes=[("CSV Files", "*.csv"), ("Excel Files", "*.xlsx;*.xls")])
+            if not filepath:
+                return
+            try:
+                counts = core.read_count_sheet(filepath)
+            except Exception as e:
+                messagebox.showerror("棚卸表エラー", f"棚卸表を読み込めません: {e}", parent=win)
+                return
+            show_variances(counts)
+
+        def apply_adjustments(selected_only):
+            variances = state["variances"]
+            if variances is None or variances.empty:
+                return
+            if selected_only:
+                selected = set(tree.selection())
+                if not selected:
+                    messagebox.showwarning("棚卸", "反映する行を選択してください。", parent=win)
+                    return
+                variances = variances[variances["id"].isin(selected)]
+            ok = messagebox.askyesno("確認", f"{len(variances)} 品目の数量を実棚数に合わせます。よろしいですか？", parent=win)
+            if not ok:
+                return
+            adjustments = core.apply_stocktake_adjustments(self.inventory_data, variances)
+            for item, _ in adjustments:
+                self.sort_index.update_item(self.inventory_data, item)
+            self.update_inventory_display()
+            if not self.save_inventory_to_excel([item for item, _ in adjustments]):
+                return
+            self.check_low_stock()
+            for item, variance in adjustments:
+                self.record_log("棚卸調整", item, variance)
+            applied_ids = set(variances["id"])
+            state["variances"] = state["variances"][~state["variances"]["id"].isin(applied_ids)]
+            tree.delete(*[iid for iid in applied_ids if tree.exists(iid)])
+            messagebox.showinfo("棚卸完了", f"{len(adjustments)} 品目の数量を調整しました。", parent=win)
+
+        tk.Button(top_frame, text="QRスキャンで計数", width=15, command=scan_counts).pack(side="left", padx=5)
+        tk.Button(top_frame, text="スキャン分を照合", width=15, command=compare_scanned).pack(side="left", padx=5)
+        tk.Button(top_frame, text="棚卸表を読込", width=15, command=load_count_sheet).pack(side="left", padx=5)
+        count_label.pack(side="left", padx=10)
+
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="選択行を反映", width=15, command=lambda: apply_adjustments(True)).pack(side="left", padx=5)
+        tk.Button(btn_frame, text="全件反映", width=15, command=lambda: apply_adjustments(False)).pack(side="left", padx=5)
+        tk.Button(btn_frame, text="閉じる", width=15, command=win.destroy).pack(side="left", padx=5)
+
+    def save_inventory_to_excel(self, touched_items=None):
+        """台帳を保存し、保存できた場合は True を返す。シャード台帳では touched_items の保管場所のシャードだけを書き出す
+
+        この画面での変更を他の端末の変更に重ねられない場合は保存せず、台帳を読み直す。
+        excel_write の計測は書き出しだけを対象にする（外部更新の取り込みや確認ダイアログ、画面の更新は含めない）。
+        """
+        try:
+            if self.sharded_ledger is not None:
+                with METRICS.stage("excel_write"):
+                    changed = self.sharded_ledger.save(self.inventory_data, touched_items)
+                if changed:
+                    self.on_shard_loaded()
+                return True
+            if self.ledger_watcher is not None and not self.merge_external_changes(touched_items):
+                return False
+            with METRICS.stage("excel_write"):
+                core.save_inventory(self.EXCEL_FILE, self.inventory_data)
+            if self.ledger_watcher is not None:
+                # 自分で保存した内容を外部更新として読み直さないようにする
+                self.ledger_watcher.mark_synced(self.inventory_data)
             # messagebox.showinfo("Excel保存", f"在庫台帳がExcelファイルに保存されました: {self.EXCEL_FILE}")
+            return True
+        except core.LedgerConflictError as e:
+            messagebox.showerror("Excel保存エラー", f"{e}\n台帳を読み直します。最新の在庫で操作をやり直してください。")
+            self.load_ledger_in_background()
+            return False
         except Exception as e:
             messagebox.showerror("Excel保存エラー", f"Excel保存に失敗しました: {e}")
+            return False
 
     def register_new_product(self):
         top = tk.Toplevel(self.root)
@@ -597,6 +1087,9 @@ class InventoryApp:
                 if str(prod.get("id")).strip() == product_id:
                     messagebox.showwarning("入力エラー", "すでに同じIDが存在します。")
                     return
+            if self.sharded_ledger is not None and product_id in self.sharded_ledger.directory:
+                messagebox.showwarning("入力エラー", "すでに同じIDが他の保管場所に存在します。")
+                return
             try:
                 quantity = int(quantity_str)
                 threshold = int(threshold_str)
@@ -617,7 +1110,7 @@ class InventoryApp:
             self.update_inventory_display()
             self.update_category_checkboxes()
             self.update_location_checkboxes()
-            self.save_inventory_to_excel()
+            self.save_inventory_to_excel([new_product])
             top.destroy()
 
         tk.Button(top, text="登録", command=submit).grid(row=6, column=0, padx=10, pady=15)
@@ -639,21 +1132,31 @@ class InventoryApp:
         btn_specs = [
             ("入庫", self.stock_in),
             ("出庫", self.stock_out),
+            ("一括入出庫", self.open_batch_movements),
+            ("棚卸", self.open_stocktake),
             ("発注", self.order_product),
             ("台帳入力", self.open_inventory_input),
             ("設定", self.open_settings),
             ("終了", self.root.destroy)
         ]
+        self.action_buttons = []
         for text, command in btn_specs:
             btn = tk.Button(self.button_frame, text=text, command=command, width=15)
             btn.pack(side="left", padx=5, pady=5)
+            if command != self.root.destroy:
+                self.action_buttons.append(btn)
+
+    def set_action_buttons_state(self, state):
+        """終了ボタン以外の機能ボタンを有効/無効にする"""
+        for btn in self.action_buttons:
+            btn.configure(state=state)
 
     def order_product(self):
         """発注ボタン押下時の処理。対象商品を選択し、発注中フラグを立てる。"""
         selected = self.inventory_tree.selection()
         if selected:
             item_values = self.inventory_tree.item(selected[0], "values")
-            selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(item_values[0])), None)
+            selected_item = core.find_item_by_id(self.inventory_data, item_values[0])
         else:
             use_manual = messagebox.askyesno("ID入力確認", 
                                 "リストに選択がありません。\nIDを手動で入力しますか？\n「いいえ」を選択すると、再度リストから選択できます。")
@@ -661,7 +1164,7 @@ class InventoryApp:
                 entered_id = ask_centered_string(self.root, "ID入力", "発注する商品のIDを入力してください:")
                 if not entered_id:
                     return
-                selected_item = next((item for item in self.inventory_data if str(item["id"]) == str(entered_id)), None)
+                selected_item = self.find_item(entered_id)
                 if not selected_item:
                     return messagebox.showerror("品番エラー", "入力されたIDに対応する品番が見つかりません。")
             else:
@@ -717,24 +1220,19 @@ class InventoryApp:
             self.sender_email = entry_sender.get().strip()
             self.sender_password = entry_sender_pw.get().strip()
             self.recipient_email = entry_recipient.get().strip()
-            self.EXCEL_FILE = entry_excel.get().strip()
+            new_excel_file = entry_excel.get().strip()
             messagebox.showinfo("設定完了", "メールおよび台帳設定を更新しました。")
             settings_win.destroy()
+            if new_excel_file != self.EXCEL_FILE:
+                # 新しい台帳の読み込みに成功した時点で切り替える
+                self.load_ledger_in_background(new_excel_file)
 
         tk.Button(settings_win, text="保存", command=save_settings).grid(row=4, column=0, padx=10, pady=15)
         tk.Button(settings_win, text="キャンセル", command=settings_win.destroy).grid(row=4, column=1, padx=10, pady=15)
 
     def check_low_stock(self):
-        low_stock_items = []
-        for item in self.inventory_data:
-            qty = item.get("quantity", 0)
-            if pd.isna(qty):
-                qty = 0
-            else:
-                qty = int(qty)
-            # order_pending が True の場合は既に発注中なので通知対象外とする
-            if qty <= self.LOW_STOCK_THRESHOLD and not item.get("order_pending", False):
-                low_stock_items.append(item)
+        with METRICS.stage("low_stock_scan"):
+            low_stock_items = core.find_low_stock_items(self.inventory_data, self.LOW_STOCK_THRESHOLD)
         if low_stock_items:
             items_str = "\n".join([
                 f"{item['name']} (在庫: {0 if pd.isna(item.get('quantity', 0)) else int(item.get('quantity', 0))})"
@@ -743,6 +1241,7 @@ class InventoryApp:
             messagebox.showwarning("在庫注意", f"以下の商品で在庫数量が少なくなっています:\n{items_str}")
             send_low_stock_email_no_oauth(low_stock_items, self.sender_email, self.sender_password, self.recipient_email)
 
+    @timed("smtp")
     def send_low_stock_email(self, low_stock_items):
         sender_email = os.getenv("GMAIL_USER", self.sender_email)
         sender_password = os.getenv("GMAIL_APP_PASSWORD", self.sender_password)
@@ -754,11 +1253,11 @@ class InventoryApp:
             for item in low_stock_items
         ])
 
-        msg = MIMEMultipart()
+        msg = mime_multipart.MIMEMultipart()
         msg['From'] = sender_email
         msg['To'] = recipient_email
         msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+        msg.attach(mime_text.MIMEText(body, 'plain'))
 
         try:
             server = smtplib.SMTP('smtp.gmail.com', 587, timeout=5)
@@ -766,10 +1265,39 @@ class InventoryApp:
             server.login(sender_email, sender_password)
             server.sendmail(sender_email, recipient_email, msg.as_string())
             server.quit()
+            METRICS.increment("email.sent")
             print("在庫不足通知メールを送信しました。")
         except Exception as e:
+            METRICS.increment("email.failed")
             print("メール送信に失敗しました:", e)
 
+    def export_metrics(self, reschedule=True):
+        """計測値を METRICS_FILE に書き出す"""
+        try:
+            METRICS.export(self.metrics_file)
+        except Exception as e:
+            print("計測値の書き出しに失敗しました:", e)
+        if reschedule:
+            self.root.after(self.metrics_interval_ms, self.export_metrics)
+
+    def open_metrics_panel(self):
+        """ステージ別の処理時間を表示するデバッグパネル（1秒ごとに更新）"""
+        panel = tk.Toplevel(self.root)
+        panel.title("処理時間計測")
+        text = tk.Text(panel, width=70, height=20, font=("Courier", 10))
+        text.pack(padx=10, pady=10, fill="both", expand=True)
+        tk.Button(panel, text="リセット", width=15, command=METRICS.reset).pack(side="left", padx=10, pady=5)
+        tk.Button(panel, text="閉じる", width=15, command=panel.destroy).pack(side="right", padx=10, pady=5)
+
+        def refresh():
+            if not panel.winfo_exists():
+                return
+            text.delete("1.0", tk.END)
+            text.insert(tk.END, "\n".join(METRICS.summary_lines()))
+            panel.after(1000, refresh)
+
+        refresh()
+
     def record_log(self, action, item, quantity):
         log_message = f"{action}: {item['name']} (ID: {item['id']}) - 数量: {quantity}"
         print(log_message)
@@ -778,3 +1306,5 @@ if __name__ == "__main__":
     root = tk.Tk()
     app = InventoryApp(root)
     root.mainloop()
+    if getattr(app, "metrics_file", None):
+        app.export_metrics(reschedule=False)